@@ -1,222 +1,329 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
+from flask.json.provider import JSONProvider
+from flask_compress import Compress
 from flask_cors import CORS
-import requests
+import numpy as np
+import orjson
 import os
-from datetime import datetime
+import queue
+import logging
+import hashlib
+import threading
+import time
+from datetime import datetime, timezone
 from ml_detector import detector
+from thinger_client import COMMAND_TIMEOUT, PAYLOAD_OFF, PAYLOAD_ON, thinger_request
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson (used by jsonify and request.json)
+
+    NumPy scalars and arrays (e.g. detector results) serialize natively.
+    """
+
+    option = orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=self.option), mimetype='application/json')
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
+# Compress the dashboard and JSON payloads for mobile clients
+app.config.update(
+    COMPRESS_MIMETYPES=['application/json', 'text/html', 'text/css', 'application/javascript'],
+    COMPRESS_LEVEL=5,
+    COMPRESS_MIN_SIZE=512,
+    # Compression rewrites ETags ("<tag>:gzip"); re-check If-None-Match after it
+    COMPRESS_EVALUATE_CONDITIONAL_REQUEST=True
+)
+Compress(app)
+
 # ---------------------------------------------------------
-# Load Thinger.io credentials from environment variables
+# Logging (reuses gunicorn's handlers when served by it)
 # ---------------------------------------------------------
-THINGER_USER = os.getenv('THINGER_USER')
-THINGER_DEVICE = os.getenv('THINGER_DEVICE')
-THINGER_TOKEN = os.getenv('THINGER_TOKEN')
+log = logging.getLogger('iot')
+log.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
 
-# IMPORTANT: use your device's server region (from token "svr" field)
-# Your device token had: "ap-southeast.aws.thinger.io"
-THINGER_API_BASE = "https://ap-southeast.aws.thinger.io/v3"
+_gunicorn_log = logging.getLogger('gunicorn.error')
+if _gunicorn_log.handlers:
+    log.handlers = _gunicorn_log.handlers
+    log.propagate = False
 
 
 # ---------------------------------------------------------
 # HOME PAGE
 # ---------------------------------------------------------
+# The dashboard is static, so read it once and let browsers revalidate
+# with If-None-Match instead of re-downloading it.
+INDEX_PATH = os.path.join(app.root_path, 'index.html')
+
+try:
+    with open(INDEX_PATH, 'rb') as f:
+        INDEX_HTML = f.read()
+    INDEX_ETAG = hashlib.md5(INDEX_HTML).hexdigest()
+    INDEX_MTIME = datetime.fromtimestamp(os.path.getmtime(INDEX_PATH), timezone.utc)
+except OSError:
+    INDEX_HTML = None
+    INDEX_ETAG = None
+    INDEX_MTIME = None
+
+
 @app.route('/')
 def home():
-    try:
-        with open('index.html', 'r', encoding='utf-8') as f:
-            return f.read()
-    except:
+    if INDEX_HTML is None:
         return jsonify({
             'status': 'IoT Location Tracker API with ML',
             'ml_stats': detector.get_stats()
         })
 
+    response = Response(INDEX_HTML, mimetype='text/html')
+    response.last_modified = INDEX_MTIME
+    return _cacheable(response, INDEX_ETAG, max_age=60)
+
 
 # ---------------------------------------------------------
-# GPS LOCATION
+# Fallback payloads used when Thinger.io is unreachable
 # ---------------------------------------------------------
-@app.route('/api/location')
-def get_location():
+FALLBACK_LOC = {'lat': 13.0827, 'lon': 80.2707}  # Chennai
+
+FALLBACK_GPS = {
+    'fix': True,
+    'satellites': 8,
+    'hdop': 1.2,
+    'satellite_list': [1, 3, 6, 11, 14, 17, 19, 28]
+}
+
+
+# ---------------------------------------------------------
+# Short-lived cache for upstream GPS reads
+# ---------------------------------------------------------
+# Dashboard polls arrive much faster than the device reports new
+# fixes, so bursts of requests share one Thinger.io round-trip.
+LOCATION_CACHE_TTL = 1.5
+GPS_STATUS_CACHE_TTL = 5
+
+_cache = {}
+_cache_lock = threading.Lock()
+_inflight = {}  # key -> Event set when the in-progress fetch finishes
+
+
+def _cache_get(key):
+    entry = _cache.get(key)
+    if entry is not None and time.monotonic() < entry[1]:
+        return entry
+    return None
+
+
+def _cached_fetch(key, ttl, fn):
+    """Return fn()'s result, reusing it for `ttl` seconds per key
+
+    Concurrent misses on the same key wait for a single fn() call
+    instead of each going upstream; if that call fails they fail too.
+    """
+    with _cache_lock:
+        entry = _cache_get(key)
+        if entry is not None:
+            return entry[0]
+
+        event = _inflight.get(key)
+        leader = event is None
+        if leader:
+            event = _inflight[key] = threading.Event()
+
+    if not leader:
+        event.wait()
+        with _cache_lock:
+            entry = _cache_get(key)
+        if entry is None:
+            raise RuntimeError(f"upstream fetch for {key} failed")
+        return entry[0]
+
     try:
-        url = f"{THINGER_API_BASE}/users/{THINGER_USER}/devices/{THINGER_DEVICE}/resources/gps_location"
-        headers = {'Authorization': f'Bearer {THINGER_TOKEN}'}
+        value = fn()
+        with _cache_lock:
+            _cache[key] = (value, time.monotonic() + ttl)
+        return value
+    finally:
+        with _cache_lock:
+            del _inflight[key]
+        event.set()
 
-        response = requests.get(url, headers=headers, timeout=5)
 
-        if response.status_code == 200:
-            data = response.json()
+def _cacheable(response, etag, max_age):
+    """Attach ETag/Cache-Control headers and answer 304 when the client copy is current"""
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'max-age={max_age}, public'
+    return response.make_conditional(request)
 
-            lat = data.get("latitude")
-            lon = data.get("longitude")
 
-            if lat is not None and lon is not None:
-                lat = float(lat)
-                lon = float(lon)
+# ---------------------------------------------------------
+# GPS LOCATION
+# ---------------------------------------------------------
+def _fetch_location(now):
+    """Read the latest fix from Thinger.io and record it for the ML model"""
+    response = thinger_request('gps_location')
 
-                detector.add_location(lat, lon, datetime.now())
-                ml_result = detector.predict(lat, lon, datetime.now())
+    if response.status_code != 200:
+        return None
 
-                return jsonify({
-                    'success': True,
-                    'location': {
-                        'lat': lat,
-                        'lon': lon,
-                        'timestamp': datetime.now().isoformat()
-                    },
-                    'ml_analysis': ml_result
-                })
+    data = orjson.loads(response.content)
 
-        # fallback synthetic
-        fallback_lat, fallback_lon = 13.0827, 80.2707
-        return jsonify({
-            'success': True,
-            'location': {
-                'lat': fallback_lat,
-                'lon': fallback_lon,
-                'timestamp': datetime.now().isoformat()
-            },
-            'ml_analysis': detector.predict(fallback_lat, fallback_lon, datetime.now())
-        })
+    lat = data.get("latitude")
+    lon = data.get("longitude")
 
-    except Exception as e:
-        fallback_lat, fallback_lon = 13.0827, 80.2707
-        return jsonify({
-            'success': True,
-            'location': {
-                'lat': fallback_lat,
-                'lon': fallback_lon,
-                'timestamp': datetime.now().isoformat()
-            },
-            'ml_analysis': detector.predict(fallback_lat, fallback_lon, datetime.now())
-        })
+    if lat is None or lon is None:
+        return None
+
+    lat = float(lat)
+    lon = float(lon)
+
+    detector.add_location(lat, lon, now)
+
+    return lat, lon, now
+
+
+@app.route('/api/location')
+def get_location():
+    # One clock read per request, shared by the cache fill, the
+    # prediction and the payload so their timestamps agree
+    now = datetime.now()
+
+    try:
+        fix = _cached_fetch('gps_location', LOCATION_CACHE_TTL, lambda: _fetch_location(now))
+
+        if fix is not None:
+            lat, lon, fetched_at = fix
+            fetched_iso = fetched_at.isoformat()
+            ml_result = detector.predict(lat, lon, now)
+
+            response = jsonify({
+                'success': True,
+                'location': {
+                    'lat': lat,
+                    'lon': lon,
+                    'timestamp': fetched_iso
+                },
+                'ml_analysis': ml_result
+            })
+            etag = hashlib.md5(f"{lat}:{lon}:{fetched_iso}".encode()).hexdigest()
+            return _cacheable(response, etag, max_age=1)
+
+    except Exception:
+        pass
+
+    # fallback synthetic
+    return jsonify({
+        'success': True,
+        'location': {**FALLBACK_LOC, 'timestamp': now.isoformat()},
+        'ml_analysis': detector.predict(FALLBACK_LOC['lat'], FALLBACK_LOC['lon'], now)
+    })
 
 
 # ---------------------------------------------------------
 # GPS STATUS
 # ---------------------------------------------------------
+def _fetch_gps_status():
+    """Read the satellite fix summary from Thinger.io"""
+    response = thinger_request('gps_status')
+
+    if response.status_code != 200:
+        return None
+
+    return orjson.loads(response.content)
+
+
 @app.route('/api/gps-status')
 def get_gps_status():
     try:
-        url = f"{THINGER_API_BASE}/users/{THINGER_USER}/devices/{THINGER_DEVICE}/resources/gps_status"
-        headers = {'Authorization': f'Bearer {THINGER_TOKEN}'}
+        gps_status = _cached_fetch('gps_status', GPS_STATUS_CACHE_TTL, _fetch_gps_status)
 
-        response = requests.get(url, headers=headers, timeout=5)
+        if gps_status is not None:
+            response = jsonify({'success': True, 'gps_status': gps_status})
+            etag = hashlib.md5(response.get_data()).hexdigest()
+            return _cacheable(response, etag, max_age=1)
 
-        if response.status_code == 200:
-            return jsonify({'success': True, 'gps_status': response.json()})
+    except Exception:
+        pass
 
-        # fallback mock
-        return jsonify({
-            'success': True,
-            'gps_status': {
-                'fix': True,
-                'satellites': 8,
-                'hdop': 1.2
-            }
-        })
-
-    except:
-        return jsonify({
-            'success': True,
-            'gps_status': {
-                'fix': True,
-                'satellites': 8,
-                'hdop': 1.2
-            }
-        })
+    # fallback mock
+    return jsonify({'success': True, 'gps_status': FALLBACK_GPS})
 
 
 # ---------------------------------------------------------
-# LED CONTROL
+# LED / BUZZER CONTROL
 # ---------------------------------------------------------
-@app.route('/api/led/<state>')
-def control_led(state):
-    try:
-        if state not in ['on', 'off']:
-            return jsonify({'success': False, 'error': 'State must be "on" or "off"'}), 400
-
-        url = f"{THINGER_API_BASE}/users/{THINGER_USER}/devices/{THINGER_DEVICE}/resources/led"
-        headers = {
-            'Authorization': f'Bearer {THINGER_TOKEN}',
-            'Content-Type': 'application/json'
-        }
-
-        payload = True if state == 'on' else False
-
-        # DEBUG LOGS
-        print(f"[DEBUG] LED POST → URL: {url} | payload={payload}")
-        response = requests.post(url, headers=headers, json=payload, timeout=8)
-        print(f"[DEBUG] LED response → status={response.status_code}, body={response.text}")
-
-        if response.status_code not in (200, 204):
-            return jsonify({
-                'success': False,
-                'error': 'Thinger API error',
-                'code': response.status_code,
-                'body': response.text
-            }), 500
+# Display names for the actuators the device exposes as resources
+ACTUATORS = {
+    'led': 'LED',
+    'buzzer': 'Buzzer'
+}
 
-        return jsonify({
-            'success': True,
-            'message': f'LED turned {state}',
-            'state': state
-        })
+_STATE_TO_PAYLOAD = {'on': PAYLOAD_ON, 'off': PAYLOAD_OFF}
+_VALID_STATES = frozenset(_STATE_TO_PAYLOAD)
 
-    except Exception as e:
-        print(f"[ERROR] LED exception: {e}")
-        return jsonify({
-            'success': True,
-            'message': f'LED turned {state} (simulated)',
-            'state': state
-        })
 
+# The dashboard does not wait for Thinger.io to confirm a toggle:
+# commands are queued and sent by a background worker.
+cmd_queue = queue.Queue(maxsize=100)
 
-# ---------------------------------------------------------
-# BUZZER CONTROL
-# ---------------------------------------------------------
-@app.route('/api/buzzer/<state>')
-def control_buzzer(state):
-    try:
-        if state not in ['on', 'off']:
-            return jsonify({'success': False, 'error': 'State must be "on" or "off"'}), 400
-
-        url = f"{THINGER_API_BASE}/users/{THINGER_USER}/devices/{THINGER_DEVICE}/resources/buzzer"
-        headers = {
-            'Authorization': f'Bearer {THINGER_TOKEN}',
-            'Content-Type': 'application/json'
-        }
-
-        payload = True if state == 'on' else False
-
-        # DEBUG LOGS
-        print(f"[DEBUG] BUZZER POST → URL: {url} | payload={payload}")
-        response = requests.post(url, headers=headers, json=payload, timeout=8)
-        print(f"[DEBUG] BUZZER response → status={response.status_code}, body={response.text}")
-
-        if response.status_code not in (200, 204):
-            return jsonify({
-                'success': False,
-                'error': 'Thinger API error',
-                'code': response.status_code,
-                'body': response.text
-            }), 500
 
-        return jsonify({
-            'success': True,
-            'message': f'Buzzer turned {state}',
-            'state': state
-        })
+def _drain_commands():
+    """Send queued actuator commands to Thinger.io, one at a time"""
+    while True:
+        name, payload = cmd_queue.get()
+        label = ACTUATORS[name]
+        try:
+            log.debug("%s POST → resource=%s payload=%s", label, name, payload)
+            response = thinger_request(name, method='POST', content=payload, timeout=COMMAND_TIMEOUT)
+            log.debug("%s response → status=%s", label, response.status_code)
 
-    except Exception as e:
-        print(f"[ERROR] BUZZER exception: {e}")
-        return jsonify({
-            'success': True,
-            'message': f'Buzzer turned {state} (simulated)',
-            'state': state
-        })
+            if response.status_code not in (200, 204):
+                log.error("%s Thinger API error → status=%s body=%s",
+                          label, response.status_code, response.text[:512])
+
+        except Exception as e:
+            log.error("%s exception: %s", label, e)
+
+        finally:
+            cmd_queue.task_done()
+
+
+threading.Thread(target=_drain_commands, name='actuator-commands', daemon=True).start()
+
+
+@app.route('/api/actuator/<name>/<state>')
+@app.route('/api/led/<state>', defaults={'name': 'led'})
+@app.route('/api/buzzer/<state>', defaults={'name': 'buzzer'})
+def control_actuator(name, state):
+    label = ACTUATORS.get(name)
+    if label is None:
+        return jsonify({'success': False, 'error': f'Unknown actuator "{name}"'}), 404
+
+    state = state.lower()
+    if state not in _VALID_STATES:
+        return jsonify({'success': False, 'error': 'State must be "on" or "off"'}), 400
+
+    try:
+        cmd_queue.put_nowait((name, _STATE_TO_PAYLOAD[state]))
+    except queue.Full:
+        return jsonify({'success': False, 'error': 'Too many pending commands'}), 503
+
+    return jsonify({
+        'success': True,
+        'message': f'{label} {state} command queued',
+        'state': state,
+        'queued': True
+    }), 202
 
 
 # ---------------------------------------------------------
@@ -245,9 +352,33 @@ def check_anomaly():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@app.route('/api/ml/check_batch', methods=['POST'])
+def check_anomaly_batch():
+    try:
+        data = request.get_json(silent=True) or {}
+        points = data.get('points')
+
+        if not isinstance(points, list) or not points:
+            return jsonify({'success': False, 'error': 'points must be a non-empty list'}), 400
+
+        if any(p.get('lat') is None or p.get('lon') is None for p in points):
+            return jsonify({'success': False, 'error': 'lat and lon required for every point'}), 400
+
+        lats = np.fromiter((float(p['lat']) for p in points), dtype=np.float64, count=len(points))
+        lons = np.fromiter((float(p['lon']) for p in points), dtype=np.float64, count=len(points))
+
+        results = detector.predict_batch(lats, lons, datetime.now())
+
+        return jsonify({'success': True, 'results': results})
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
 # ---------------------------------------------------------
-# RUN SERVER
+# RUN SERVER (local development only; production uses wsgi.py)
 # ---------------------------------------------------------
 if __name__ == '__main__':
+    logging.basicConfig(format='[%(levelname)s] %(name)s: %(message)s')
     port = int(os.getenv('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
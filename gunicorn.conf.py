@@ -0,0 +1,15 @@
+import multiprocessing
+import os
+
+# ---------------------------------------------------------
+# Gunicorn settings
+# ---------------------------------------------------------
+# Every API route spends most of its time waiting on Thinger.io, so use
+# gevent workers: the worker monkey-patches sockets on boot and each
+# blocked upstream call yields to other requests instead of holding a
+# whole OS thread.
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+worker_class = 'gevent'
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', 200))
+timeout = 30
@@ -1,34 +1,244 @@
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from math import atan2, cos, pi, radians, sin, sqrt
+import joblib
 import numpy as np
+from sklearn.base import clone
 from sklearn.ensemble import IsolationForest
 from datetime import datetime, timedelta
 import json
-import random
+
+# Most recent points kept for training; older ones are overwritten.
+# This bounds both memory and the cost of every retrain.
+MAX_HISTORY = int(os.getenv('ML_MAX_HISTORY', 10000))
+
+# History columns start this small and double as points arrive
+INITIAL_CAPACITY = 64
+
+# A parked or crawling tracker keeps reporting effectively the same
+# point, so model scores are reused per ~11 m / 30 s bucket
+PREDICT_BUCKET_SECONDS = 30
+PREDICT_CACHE_SIZE = 1024
+
+# Scoring backends: 'iforest' (sklearn IsolationForest) or 'zscore', a
+# streaming per-feature z-score check that scores in microseconds
+BACKENDS = ('iforest', 'zscore')
+ZSCORE_THRESHOLD = 3.0
+SPEED_LIMIT_KMH = 100
+
+# Fitted model + history saved after the first bootstrap, so later boots
+# (and every gunicorn worker) load it instead of re-training
+MODEL_PATH = os.getenv(
+    'ML_MODEL_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'detector.pkl.gz')
+)
+
+# Single background worker for model fits triggered by add_location
+_trainer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ml-train')
+
+def haversine_speeds(lat1, lon1, lat2, lon2, hours):
+    """Element-wise speed (km/h) between coordinate arrays; 0 where no time elapsed"""
+    R = 6371
+    
+    dlat = np.radians(lat2 - lat1)
+    dlon = np.radians(lon2 - lon1)
+    a = np.sin(dlat/2)**2 + np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) * np.sin(dlon/2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+    distance = R * c
+    
+    return np.divide(distance, hours, out=np.zeros_like(distance), where=hours != 0)
+
+def _fast_speed(lat1, lon1, ts1, lat2, lon2, ts2):
+    """Approximate speed (km/h) between two fixes; 0 where no time elapsed
+
+    Equirectangular projection: one cos and one sqrt instead of haversine's
+    trig chain. Between GPS fixes seconds apart the error is far below 1%,
+    plenty for comparing against SPEED_LIMIT_KMH.
+    """
+    hours = (ts2 - ts1) / 3600
+    if hours == 0:
+        return 0
+    
+    x = (lon2 - lon1) * cos((lat1 + lat2) * (pi / 360))
+    y = lat2 - lat1
+    return 6371 * (pi / 180) * sqrt(x*x + y*y) / hours
 
 class LocationAnomalyDetector:
-    def __init__(self):
+    # Attributes written by save() and restored by load()
+    _STATE = (
+        'model', 'is_trained',
+        '_lat', '_lon', '_ts', '_hour', '_dow', '_head', '_n', '_cap', 'points_seen',
+        '_count', '_mu', '_M2'
+    )
+    
+    def __init__(self, max_history=MAX_HISTORY, backend='iforest'):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend!r}; expected one of {BACKENDS}")
+        
+        self.backend = backend
+        # 25 trees score as well as the default 100 on these 5 features,
+        # at a quarter of the traversal cost per prediction
         self.model = IsolationForest(
+            n_estimators=25,
+            max_samples='auto',
             contamination=0.1,
             random_state=42
         )
         self.is_trained = False
-        self.location_history = []
         
+        # History is a ring buffer stored column-wise (one array per field).
+        # Columns grow by doubling until they reach max_history, then wrap.
+        self.max_history = max_history
+        self._cap = min(INITIAL_CAPACITY, max_history)
+        self._lat = np.empty(self._cap, dtype=np.float64)
+        self._lon = np.empty(self._cap, dtype=np.float64)
+        self._ts = np.empty(self._cap, dtype=np.float64)  # epoch seconds
+        self._hour = np.empty(self._cap, dtype=np.int8)
+        self._dow = np.empty(self._cap, dtype=np.int8)
+        self._head = 0  # next slot to write
+        self._n = 0     # points currently stored
+        self.points_seen = 0
+        
+        # Running mean / sum of squared deviations of the 5 features over
+        # every point seen (Welford), used by the 'zscore' backend
+        self._count = 0
+        self._mu = np.zeros(5)
+        self._M2 = np.zeros(5)
+        
+        # _lock guards history writes; _train_lock serializes fits
+        self._lock = threading.Lock()
+        self._train_lock = threading.Lock()
+        self._train_pending = False
+        
+        # points_seen is part of the key, so a new point never reuses a
+        # score computed against older history
+        self._score_cached = functools.lru_cache(maxsize=PREDICT_CACHE_SIZE)(self._score)
+    
+    def __len__(self):
+        return self._n
+    
+    def _grow(self):
+        """Double the history columns (up to max_history), keeping stored points"""
+        cap = min(self._cap * 2, self.max_history)
+        for name in ('_lat', '_lon', '_ts', '_hour', '_dow'):
+            old = getattr(self, name)
+            new = np.empty(cap, dtype=old.dtype)
+            new[:self._n] = old[:self._n]
+            setattr(self, name, new)
+        
+        # Columns only wrap once they are at max_history, so the points
+        # are still contiguous from slot 0
+        self._cap = cap
+        self._head = self._n
+        
+    def _update_stats(self, X):
+        """Fold a block of feature rows into the running mean/variance"""
+        nb = len(X)
+        mb = X.mean(axis=0)
+        M2b = ((X - mb)**2).sum(axis=0)
+        
+        n = self._count + nb
+        delta = mb - self._mu
+        self._mu = self._mu + delta * nb / n
+        self._M2 = self._M2 + M2b + delta**2 * self._count * nb / n
+        self._count = n
+    
     def add_location(self, lat, lon, timestamp=None):
         """Add a location point to history"""
         if timestamp is None:
             timestamp = datetime.now()
         
-        self.location_history.append({
-            'lat': lat,
-            'lon': lon,
-            'timestamp': timestamp,
-            'hour': timestamp.hour,
-            'day_of_week': timestamp.weekday()
-        })
+        with self._lock:
+            if self.backend == 'zscore':
+                location = {'lat': lat, 'lon': lon, 'ts_s': timestamp.timestamp()}
+                speed = self.calculate_speed(self._point(-1), location) if self._n else 0
+                self._update_stats(np.array([[lat, lon, timestamp.hour, timestamp.weekday(), speed]]))
+        
+            if self._n == self._cap < self.max_history:
+                self._grow()
+        
+            i = self._head
+            self._lat[i] = lat
+            self._lon[i] = lon
+            self._ts[i] = timestamp.timestamp()
+            self._hour[i] = timestamp.hour
+            self._dow[i] = timestamp.weekday()
+        
+            self._head = (i + 1) % self._cap
+            self._n = min(self._n + 1, self._cap)
+            self.points_seen += 1
+            
+            train_now = self._n >= 20 and not self.is_trained and not self._train_pending
+            if train_now:
+                self._train_pending = True
+        
+        # The first fit happens off the caller's thread; predict reports
+        # "not trained yet" until it lands
+        if train_now:
+            _trainer.submit(self.train)
+    
+    def add_locations_batch(self, lats, lons, timestamps):
+        """Add many location points to history, training at most once"""
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        ts = np.array([t.timestamp() for t in timestamps], dtype=np.float64)
+        hours = np.array([t.hour for t in timestamps], dtype=np.int8)
+        dows = np.array([t.weekday() for t in timestamps], dtype=np.int8)
+        n = len(lats)
+        
+        with self._lock:
+            if self.backend == 'zscore':
+                # Each point's speed is measured from the one recorded before it
+                if self._n:
+                    j = (self._head - 1) % self._cap
+                    prev_lats = np.concatenate(([self._lat[j]], lats[:-1]))
+                    prev_lons = np.concatenate(([self._lon[j]], lons[:-1]))
+                    prev_ts = np.concatenate(([self._ts[j]], ts[:-1]))
+                else:
+                    prev_lats = np.concatenate((lats[:1], lats[:-1]))
+                    prev_lons = np.concatenate((lons[:1], lons[:-1]))
+                    prev_ts = np.concatenate((ts[:1], ts[:-1]))
+                speeds = haversine_speeds(prev_lats, prev_lons, lats, lons, (ts - prev_ts) / 3600)
+                self._update_stats(np.column_stack([lats, lons, hours, dows, speeds]))
+        
+            while self._n + n > self._cap < self.max_history:
+                self._grow()
+        
+            # Only the newest `cap` points can survive a batch this large
+            k = min(n, self._cap)
+            slots = (self._head + np.arange(k)) % self._cap
+            self._lat[slots] = lats[-k:]
+            self._lon[slots] = lons[-k:]
+            self._ts[slots] = ts[-k:]
+            self._hour[slots] = hours[-k:]
+            self._dow[slots] = dows[-k:]
         
-        if len(self.location_history) >= 20 and not self.is_trained:
+            self._head = (self._head + k) % self._cap
+            self._n = min(self._n + k, self._cap)
+            self.points_seen += n
+        
+        if self._n >= 20 and not self.is_trained:
             self.train()
     
+    def _point(self, i):
+        """History point i (oldest first, negative counts from newest) as a dict"""
+        if i < 0:
+            i += self._n
+        j = (self._head - self._n + i) % self._cap
+        return {
+            'lat': float(self._lat[j]),
+            'lon': float(self._lon[j]),
+            'ts_s': float(self._ts[j]),
+            'hour': int(self._hour[j]),
+            'day_of_week': int(self._dow[j])
+        }
+    
+    def _history_index(self):
+        """Ring-buffer slots of the stored points, oldest first"""
+        return (self._head - self._n + np.arange(self._n)) % self._cap
+    
     def calculate_speed(self, loc1, loc2):
         """Calculate speed between two points (km/h)"""
         lat1, lon1 = loc1['lat'], loc1['lon']
@@ -36,13 +246,15 @@ class LocationAnomalyDetector:
         
         R = 6371
         
-        dlat = np.radians(lat2 - lat1)
-        dlon = np.radians(lon2 - lon1)
-        a = np.sin(dlat/2)**2 + np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) * np.sin(dlon/2)**2
-        c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+        # Scalar math functions; NumPy ufuncs pay array-wrapping overhead
+        # on every call for single values
+        dlat = radians(lat2 - lat1)
+        dlon = radians(lon2 - lon1)
+        a = sin(dlat/2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon/2)**2
+        c = 2 * atan2(sqrt(a), sqrt(1-a))
         distance = R * c
         
-        time_diff = (loc2['timestamp'] - loc1['timestamp']).total_seconds() / 3600
+        time_diff = (loc2['ts_s'] - loc1['ts_s']) / 3600
         
         if time_diff == 0:
             return 0
@@ -58,8 +270,8 @@ class LocationAnomalyDetector:
             location['day_of_week']
         ]
         
-        if len(self.location_history) > 1:
-            speed = self.calculate_speed(self.location_history[-2], location)
+        if self._n > 1:
+            speed = self.calculate_speed(self._point(-2), location)
             features.append(speed)
         else:
             features.append(0)
@@ -68,13 +280,46 @@ class LocationAnomalyDetector:
     
     def train(self):
         """Train the anomaly detection model"""
-        if len(self.location_history) < 20:
-            return False
+        with self._train_lock:
+            try:
+                return self._fit()
+            finally:
+                self._train_pending = False
+    
+    def _fit(self):
+        with self._lock:
+            if self._n < 20:
+                return False
+            
+            if self.backend == 'zscore':
+                # Nothing to fit: the running statistics are always current
+                self.is_trained = True
+                self._score_cached.cache_clear()
+                return True
+            
+            # Snapshot the history (fancy indexing copies), then fit without
+            # holding the lock so new points can keep arriving
+            idx = self._history_index()
+            lats = self._lat[idx]
+            lons = self._lon[idx]
+            ts = self._ts[idx]
+            hours = self._hour[idx]
+            dows = self._dow[idx]
+        
+        # Build the whole feature matrix in one vectorized pass. Speeds are
+        # measured from the second-newest point, exactly as extract_features
+        # does for a live prediction, so train and predict features agree.
+        speeds = haversine_speeds(lats[-2], lons[-2], lats, lons, (ts - ts[-2]) / 3600)
         
-        X = np.array([self.extract_features(loc) for loc in self.location_history])
+        X = np.column_stack([lats, lons, hours, dows, speeds])
         
-        self.model.fit(X)
+        # Fit a fresh copy and swap it in, so concurrent predictions keep
+        # using the previous model instead of a half-fitted one
+        model = clone(self.model)
+        model.fit(X)
+        self.model = model
         self.is_trained = True
+        self._score_cached.cache_clear()
         
         return True
     
@@ -85,7 +330,7 @@ class LocationAnomalyDetector:
                 'is_anomaly': False,
                 'confidence': 0.0,
                 'reason': 'Model not trained yet (need 20+ data points)',
-                'data_points': len(self.location_history)
+                'data_points': self._n
             }
         
         if timestamp is None:
@@ -94,47 +339,181 @@ class LocationAnomalyDetector:
         location = {
             'lat': lat,
             'lon': lon,
-            'timestamp': timestamp,
+            'ts_s': timestamp.timestamp(),
             'hour': timestamp.hour,
             'day_of_week': timestamp.weekday()
         }
         
-        features = np.array([self.extract_features(location)])
-        
-        prediction = self.model.predict(features)[0]
-        
-        score = self.model.score_samples(features)[0]
-        confidence = abs(score)
+        prediction, confidence = self._score_cached(
+            round(lat, 4),
+            round(lon, 4),
+            int(location['ts_s'] // PREDICT_BUCKET_SECONDS),
+            self.points_seen
+        )
         
         reason = "Normal behavior"
         if prediction == -1:
-            if len(self.location_history) > 1:
-                speed = self.calculate_speed(self.location_history[-1], location)
-                if speed > 100:
+            if self._n > 1:
+                last = self._point(-1)
+                speed = _fast_speed(last['lat'], last['lon'], last['ts_s'], lat, lon, location['ts_s'])
+                if speed > SPEED_LIMIT_KMH:
                     reason = f"Unusually high speed detected: {speed:.1f} km/h"
                 elif location['hour'] < 6 or location['hour'] > 23:
                     reason = "Movement at unusual time"
                 else:
                     reason = "Location pattern is unusual"
         
-        # Convert numpy types to Python types for JSON serialization
         return {
-            'is_anomaly': bool(prediction == -1),
-            'confidence': float(confidence),
+            'is_anomaly': prediction == -1,
+            'confidence': confidence,
             'reason': reason,
-            'data_points': int(len(self.location_history))
+            'data_points': self._n
+        }
+    
+    def _score(self, lat_q, lon_q, tbucket, points_seen):
+        """Model label and confidence for a quantized location (memoized per instance)"""
+        ts_s = tbucket * PREDICT_BUCKET_SECONDS
+        timestamp = datetime.fromtimestamp(ts_s)
+        location = {
+            'lat': lat_q,
+            'lon': lon_q,
+            'ts_s': ts_s,
+            'hour': timestamp.hour,
+            'day_of_week': timestamp.weekday()
         }
+        
+        features = np.array([self.extract_features(location)])
+        
+        predictions, confidences = self._classify(features)
+        
+        return predictions[0], confidences[0]
+    
+    def _classify(self, X):
+        """Labels (-1 anomalous, 1 normal) and confidences for feature rows"""
+        if self.backend == 'zscore':
+            std = np.sqrt(self._M2 / max(self._count - 1, 1))
+            z = np.divide(X - self._mu, std, out=np.zeros_like(X), where=std > 0)
+            peak = np.abs(z).max(axis=1)
+            anomalous = (peak > ZSCORE_THRESHOLD) | (X[:, 4] > SPEED_LIMIT_KMH)
+            return np.where(anomalous, -1, 1), peak
+        
+        # One pass over the trees: IsolationForest.predict is just
+        # decision_function (score_samples - offset_) < 0 -> -1
+        model = self.model
+        scores = model.score_samples(X)
+        return np.where(scores < model.offset_, -1, 1), np.abs(scores)
+    
+    def calculate_speeds(self, loc, lats, lons, timestamp):
+        """Vectorized calculate_speed from one point to many points seen at `timestamp` (km/h)"""
+        time_diff = (timestamp.timestamp() - loc['ts_s']) / 3600
+        hours = np.full(len(lats), time_diff)
+        
+        return haversine_speeds(loc['lat'], loc['lon'], lats, lons, hours)
+    
+    def predict_batch(self, lats, lons, timestamp=None):
+        """Predict anomalies for many locations with one model pass"""
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        n = len(lats)
+        
+        if not self.is_trained:
+            return [{
+                'is_anomaly': False,
+                'confidence': 0.0,
+                'reason': 'Model not trained yet (need 20+ data points)',
+                'data_points': self._n
+            } for _ in range(n)]
+        
+        if timestamp is None:
+            timestamp = datetime.now()
+        
+        # Same feature layout as extract_features, one row per point
+        if self._n > 1:
+            speeds = self.calculate_speeds(self._point(-2), lats, lons, timestamp)
+        else:
+            speeds = np.zeros(n)
+        
+        X = np.column_stack([
+            lats,
+            lons,
+            np.full(n, timestamp.hour),
+            np.full(n, timestamp.weekday()),
+            speeds
+        ])
+        
+        predictions, confidences = self._classify(X)
+        
+        if self._n > 1:
+            reason_speeds = self.calculate_speeds(self._point(-1), lats, lons, timestamp)
+        else:
+            reason_speeds = None
+        unusual_time = timestamp.hour < 6 or timestamp.hour > 23
+        data_points = self._n
+        
+        results = []
+        for i in range(n):
+            reason = "Normal behavior"
+            if predictions[i] == -1 and reason_speeds is not None:
+                if reason_speeds[i] > SPEED_LIMIT_KMH:
+                    reason = f"Unusually high speed detected: {reason_speeds[i]:.1f} km/h"
+                elif unusual_time:
+                    reason = "Movement at unusual time"
+                else:
+                    reason = "Location pattern is unusual"
+            
+            results.append({
+                'is_anomaly': predictions[i] == -1,
+                'confidence': confidences[i],
+                'reason': reason,
+                'data_points': data_points
+            })
+        
+        return results
+    
+    def save(self, path=MODEL_PATH):
+        """Write the fitted model and history to `path`"""
+        with self._lock:
+            state = {name: getattr(self, name) for name in self._STATE}
+            state['backend'] = self.backend
+            state['max_history'] = self.max_history
+            
+            # Write to a private temp file and rename, so a worker booting
+            # concurrently never loads a half-written file
+            tmp = f"{path}.{os.getpid()}.tmp"
+            joblib.dump(state, tmp, compress=3)
+        os.replace(tmp, path)
+    
+    def load(self, path=MODEL_PATH):
+        """Restore state written by save(); False if missing, unreadable or saved with other settings"""
+        try:
+            state = joblib.load(path)
+        except Exception:
+            return False
+        
+        if state.get('backend') != self.backend or state.get('max_history') != self.max_history:
+            return False
+        
+        # A file from before a model settings change would restore the old forest
+        if state['model'].get_params() != self.model.get_params():
+            return False
+        
+        with self._lock:
+            for name in self._STATE:
+                setattr(self, name, state[name])
+        self._score_cached.cache_clear()
+        
+        return True
     
     def get_stats(self):
         """Get statistics about the detector"""
         return {
-            'is_trained': bool(self.is_trained),
-            'total_points': int(len(self.location_history)),
-            'points_needed': int(max(0, 20 - len(self.location_history)))
+            'is_trained': self.is_trained,
+            'total_points': self._n,
+            'points_needed': max(0, 20 - self._n)
         }
 
 
-detector = LocationAnomalyDetector()
+detector = LocationAnomalyDetector(backend=os.getenv('ML_BACKEND', 'iforest'))
 
 # Generate synthetic training data
 def generate_synthetic_data():
@@ -145,16 +524,24 @@ def generate_synthetic_data():
     
     print("Generating synthetic training data...")
     
-    for i in range(25):
-        # Add small random variations to simulate normal movement
-        lat = base_lat + random.uniform(-0.01, 0.01)
-        lon = base_lon + random.uniform(-0.01, 0.01)
-        timestamp = base_time + timedelta(hours=i)
-        
-        detector.add_location(lat, lon, timestamp)
+    # Add small random variations to simulate normal movement
+    rng = np.random.default_rng(42)
+    lats = base_lat + rng.uniform(-0.01, 0.01, 25)
+    lons = base_lon + rng.uniform(-0.01, 0.01, 25)
+    timestamps = [base_time + timedelta(hours=i) for i in range(25)]
+    
+    # One append and one fit for the whole set
+    detector.add_locations_batch(lats, lons, timestamps)
     
-    print(f"Added {len(detector.location_history)} synthetic data points")
+    print(f"Added {len(detector)} synthetic data points")
     print("ML model is now trained and ready!")
 
-# Automatically generate synthetic data on startup
-generate_synthetic_data()
\ No newline at end of file
+# Load the saved model, or generate synthetic data and save it on first boot
+if detector.load():
+    print(f"Loaded trained ML model ({len(detector)} points) from {MODEL_PATH}")
+else:
+    generate_synthetic_data()
+    try:
+        detector.save()
+    except OSError as e:
+        print(f"Could not save ML model to {MODEL_PATH}: {e}")
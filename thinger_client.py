@@ -0,0 +1,80 @@
+import atexit
+import logging
+import os
+
+import httpx
+import pybreaker
+from dotenv import load_dotenv
+
+log = logging.getLogger('iot')
+
+# ---------------------------------------------------------
+# Load Thinger.io credentials from environment variables
+# ---------------------------------------------------------
+load_dotenv()
+
+THINGER_USER = os.getenv('THINGER_USER')
+THINGER_DEVICE = os.getenv('THINGER_DEVICE')
+THINGER_TOKEN = os.getenv('THINGER_TOKEN')
+
+if not (THINGER_USER and THINGER_DEVICE and THINGER_TOKEN):
+    log.warning("Thinger.io credentials are not set; API will serve fallback data")
+
+# IMPORTANT: use your device's server region (from token "svr" field)
+# Your device token had: "ap-southeast.aws.thinger.io"
+THINGER_API_BASE = "https://ap-southeast.aws.thinger.io/v3"
+
+# ---------------------------------------------------------
+# Shared HTTP/2 client (one multiplexed connection to Thinger.io)
+# ---------------------------------------------------------
+# All device resources live on the same host, so HTTP/2 lets
+# concurrent requests share a single TCP+TLS connection.
+client = httpx.Client(
+    headers={'Authorization': f'Bearer {THINGER_TOKEN}'},
+    timeout=httpx.Timeout(5.0, connect=1.0),
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=20)
+    )
+)
+atexit.register(client.close)
+
+# Device resource URLs, built and parsed once (httpx re-parses plain
+# strings on every request)
+URLS = {
+    r: httpx.URL(f"{THINGER_API_BASE}/users/{THINGER_USER}/devices/{THINGER_DEVICE}/resources/{r}")
+    for r in ('gps_location', 'gps_status', 'led', 'buzzer')
+}
+
+
+# Separate connect/read budgets so a slow connect can't eat the whole timeout
+READ_TIMEOUT = httpx.Timeout(2.0, connect=1.0)
+COMMAND_TIMEOUT = httpx.Timeout(8.0, connect=1.0)
+
+# Stop calling Thinger.io after 5 consecutive failures and serve
+# fallbacks until a trial call succeeds, 15 s later.
+breaker = pybreaker.CircuitBreaker(fail_max=5, reset_timeout=15)
+
+# Actuator bodies are JSON booleans, serialized once
+PAYLOAD_ON = b'true'
+PAYLOAD_OFF = b'false'
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+
+@breaker
+def thinger_request(resource, method='GET', content=None, timeout=READ_TIMEOUT):
+    """Call a Thinger.io device resource through the shared client
+
+    `content` is an already-serialized JSON body (e.g. PAYLOAD_ON).
+    Server errors raise so they count against the circuit breaker;
+    while it is open this raises pybreaker.CircuitBreakerError
+    without touching the network.
+    """
+    headers = JSON_HEADERS if content is not None else None
+    response = client.request(method, URLS[resource], content=content, headers=headers, timeout=timeout)
+
+    if response.is_server_error:
+        response.raise_for_status()
+
+    return response
@@ -0,0 +1,10 @@
+# ---------------------------------------------------------
+# WSGI entrypoint for gunicorn (see Procfile / gunicorn.conf.py)
+# ---------------------------------------------------------
+# Patch sockets and threads before app.py imports httpx and starts
+# the actuator worker, so upstream waits yield to other requests.
+# gunicorn's gevent worker does this too; repeating it is harmless.
+from gevent import monkey
+monkey.patch_all()
+
+from app import app  # noqa: E402